@@ -1,23 +1,314 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
-from PIL import Image, ImageFilter
+from PIL import Image
 import io
 import base64
 import os
 import cv2
 import numpy as np
 import json
+import queue
+import sqlite3
+import threading
+
+# pybase64 uses SIMD (SSSE3/AVX2) encoders; fall back to the stdlib if unavailable
+try:
+    import pybase64
+except ImportError:
+    pybase64 = None
+
+# Numba compiles the face matching loop to parallel native code; fall back to NumPy if unavailable
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-# Simple in-memory storage for face data (in production, use a proper database)
-face_database = {
-    'faces': [],  # List of known face encodings
-    'names': [],  # Corresponding names
-    'attendance': []  # Attendance records
+# Load a pool of OpenCV face detection models once at startup; CascadeClassifier
+# keeps per-image state while detecting, so each request borrows its own
+# instance. Sized to the gunicorn thread count in the Procfile.
+FACE_CASCADE_PATH = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+FACE_CASCADE_POOL_SIZE = int(os.environ.get('FACE_CASCADE_POOL_SIZE', 4))
+FACE_CASCADES = queue.Queue()
+for _ in range(FACE_CASCADE_POOL_SIZE):
+    FACE_CASCADES.put(cv2.CascadeClassifier(FACE_CASCADE_PATH))
+
+_thread_local = threading.local()
+
+# DNN models run on CUDA when OpenCV was built with it, otherwise on the CPU
+if cv2.cuda.getCudaEnabledDeviceCount() > 0:
+    DNN_BACKEND, DNN_TARGET = cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA
+else:
+    DNN_BACKEND, DNN_TARGET = cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_CPU
+
+# Optional DNN face detector (YuNet). Set FACE_DETECTOR_MODEL to the path of
+# face_detection_yunet_*.onnx to enable it; the Haar cascade above stays as
+# the fallback.
+FACE_DETECTOR_MODEL = os.environ.get('FACE_DETECTOR_MODEL', '')
+FACE_DETECTOR = None
+if FACE_DETECTOR_MODEL and os.path.isfile(FACE_DETECTOR_MODEL):
+    FACE_DETECTOR = cv2.FaceDetectorYN.create(
+        FACE_DETECTOR_MODEL, '', (320, 320), 0.5, 0.3, 5000, DNN_BACKEND, DNN_TARGET
+    )
+# YuNet keeps the input size as state, so calls must not interleave
+FACE_DETECTOR_LOCK = threading.Lock()
+
+# Optional face recognizer (SFace). Set FACE_RECOGNIZER_MODEL to the path of
+# face_recognition_sface_*.onnx to store 128-d embeddings for registered faces
+# and recognize them in /detect-faces.
+FACE_RECOGNIZER_MODEL = os.environ.get('FACE_RECOGNIZER_MODEL', '')
+FACE_RECOGNIZER = None
+if FACE_RECOGNIZER_MODEL and os.path.isfile(FACE_RECOGNIZER_MODEL):
+    FACE_RECOGNIZER = cv2.FaceRecognizerSF.create(FACE_RECOGNIZER_MODEL, '', DNN_BACKEND, DNN_TARGET)
+FACE_RECOGNIZER_LOCK = threading.Lock()
+FACE_EMBEDDING_SIZE = 128
+# Cosine similarity above which two SFace embeddings are the same person
+FACE_MATCH_THRESHOLD = 0.363
+
+# Haar only looks at luminance, so let the codec decode straight to grayscale
+# unless a DNN model needs the colour image
+if FACE_DETECTOR is not None or FACE_RECOGNIZER is not None:
+    FACE_IMREAD_FLAGS = cv2.IMREAD_COLOR
+else:
+    FACE_IMREAD_FLAGS = cv2.IMREAD_GRAYSCALE
+
+def decode_image(file, flags=cv2.IMREAD_COLOR):
+    """Decode an uploaded file into a numpy image, or None if it isn't one"""
+    # Decoding stays on the CPU: the detectors and filters read host memory,
+    # so a GPU decode would only add a device-to-host copy back
+    data = file.read()
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+    if image is None:
+        # OpenCV can't read some formats PIL can (GIF, ICO, TGA)
+        image = decode_image_pil(data, flags)
+    return image
+
+def decode_image_pil(data, flags):
+    """Decode image bytes with PIL into the layout cv2.imdecode gives for flags"""
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    if flags == cv2.IMREAD_UNCHANGED:
+        # Keep gray and alpha uploads as they are, like IMREAD_UNCHANGED
+        if image.mode in ('1', 'L'):
+            return np.asarray(image.convert('L'))
+        if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+            return cv2.cvtColor(np.asarray(image.convert('RGBA')), cv2.COLOR_RGBA2BGRA)
+        return cv2.cvtColor(np.asarray(image.convert('RGB')), cv2.COLOR_RGB2BGR)
+    if flags & cv2.IMREAD_COLOR:
+        return cv2.cvtColor(np.asarray(image.convert('RGB')), cv2.COLOR_RGB2BGR)
+    return np.asarray(image.convert('L'))
+
+def find_faces(image):
+    """Detect faces in a BGR or grayscale image
+
+    Returns a list of (x, y, w, h, confidence, detection) tuples, where
+    detection is the raw YuNet row (with landmarks) or None for Haar.
+    """
+    height, width = image.shape[:2]
+
+    if FACE_DETECTOR is not None:
+        with FACE_DETECTOR_LOCK:
+            FACE_DETECTOR.setInputSize((width, height))
+            _, detections = FACE_DETECTOR.detect(image)
+
+        if detections is None:
+            return []
+
+        faces = []
+        for row in detections:
+            x, y = max(int(row[0]), 0), max(int(row[1]), 0)
+            w, h = min(int(row[2]), width - x), min(int(row[3]), height - y)
+            if w > 0 and h > 0:
+                faces.append((x, y, w, h, float(row[14]), row))
+        return faces
+
+    # Convert to grayscale for face detection unless decoded that way already
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = cv2.equalizeHist(gray)
+
+    # Prune the scale pyramid: skip faces smaller than 1/8 of the short side
+    # and step scales by 1.2 rather than 1.1, which roughly halves the number
+    # of levels at a small cost in recall for faces between two scales
+    min_face = min(height, width) // 8
+    face_cascade = FACE_CASCADES.get()
+    try:
+        faces = face_cascade.detectMultiScale(
+            gray,
+            scaleFactor=1.2,
+            minNeighbors=5,
+            flags=cv2.CASCADE_SCALE_IMAGE,
+            minSize=(min_face, min_face)
+        )
+    finally:
+        FACE_CASCADES.put(face_cascade)
+
+    # Haar gives no score, so report a fixed detection confidence
+    return [(int(x), int(y), int(w), int(h), 0.8, None) for (x, y, w, h) in faces]
+
+def face_embedding(image, face):
+    """Compute an L2-normalised float32 embedding for a face found by find_faces"""
+    x, y, w, h, _, detection = face
+    if detection is not None:
+        # Use the YuNet landmarks to align the face the way SFace expects
+        aligned = FACE_RECOGNIZER.alignCrop(image, detection)
+    else:
+        aligned = cv2.resize(image[y:y+h, x:x+w], (112, 112))
+
+    with FACE_RECOGNIZER_LOCK:
+        embedding = FACE_RECOGNIZER.feature(aligned).ravel().astype(np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _best_matches(queries, embeddings):
+        """Index and cosine similarity of the closest embedding row for each query"""
+        k, n, dim = queries.shape[0], embeddings.shape[0], embeddings.shape[1]
+        similarities = np.empty((k, n), dtype=np.float32)
+        for i in prange(n):
+            for q in range(k):
+                total = np.float32(0.0)
+                for d in range(dim):
+                    total += embeddings[i, d] * queries[q, d]
+                similarities[q, i] = total
+
+        best = np.empty(k, dtype=np.int64)
+        best_similarity = np.empty(k, dtype=np.float32)
+        for q in range(k):
+            best[q] = np.argmax(similarities[q])
+            best_similarity[q] = similarities[q, best[q]]
+        return best, best_similarity
+else:
+    _best_matches = None
+FACE_MATCH_LOCK = threading.Lock()
+
+def match_faces(queries):
+    """Match a (k, 128) batch of embeddings against all registered faces
+
+    Returns a list of (name, similarity) pairs for the closest registered
+    face to each query, with name None when nothing is registered.
+    """
+    names, embeddings = registered_embeddings()
+    if len(embeddings) == 0:
+        return [(None, 0.0)] * len(queries)
+
+    # Embeddings are normalised, so dot products are cosine similarities
+    if _best_matches is not None:
+        # Numba's default threading layer can't run parallel kernels from
+        # several threads at once
+        with FACE_MATCH_LOCK:
+            best, similarity = _best_matches(queries, embeddings)
+    else:
+        similarities = queries @ embeddings.T
+        best = np.argmax(similarities, axis=1)
+        similarity = similarities[np.arange(len(best)), best]
+    return [(names[j], float(sim)) for j, sim in zip(best, similarity)]
+
+# PIL's BLUR, SHARPEN and FIND_EDGES kernels, applied with cv2.filter2D so
+# /process-image output matches what ImageFilter produced
+BLUR_KERNEL = np.array([
+    [1, 1, 1, 1, 1],
+    [1, 0, 0, 0, 1],
+    [1, 0, 0, 0, 1],
+    [1, 0, 0, 0, 1],
+    [1, 1, 1, 1, 1]
+], dtype=np.float32) / 16
+SHARPEN_KERNEL = np.array([
+    [-2, -2, -2],
+    [-2, 32, -2],
+    [-2, -2, -2]
+], dtype=np.float32) / 16
+EDGE_KERNEL = np.array([
+    [-1, -1, -1],
+    [-1, 8, -1],
+    [-1, -1, -1]
+], dtype=np.float32)
+FILTER_KERNELS = {
+    'blur': BLUR_KERNEL,
+    'sharpen': SHARPEN_KERNEL,
+    'edge': EDGE_KERNEL
 }
 
+PNG_ENCODE_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+# Bytes of input per base64 chunk; a multiple of 3 so chunks concatenate
+# without padding in between
+B64_CHUNK_SIZE = 48 * 1024
+
+def b64encode_chunks(data):
+    """Yield the base64 encoding of a bytes-like object in chunks"""
+    encode = pybase64.b64encode if pybase64 is not None else base64.b64encode
+    view = memoryview(data).cast('B')  # Flat byte view, no copy
+    for start in range(0, len(view), B64_CHUNK_SIZE):
+        yield encode(view[start:start + B64_CHUNK_SIZE])
+
+# Registered faces and attendance live in SQLite so every gunicorn worker
+# sees the same data; embeddings are stored as raw float32 BLOBs
+DATABASE_PATH = os.environ.get('FACE_DATABASE_PATH', 'faces.db')
+
+def get_db():
+    """Return this thread's SQLite connection, opening it on first use"""
+    if not hasattr(_thread_local, 'db'):
+        _thread_local.db = sqlite3.connect(DATABASE_PATH, timeout=30)
+    return _thread_local.db
+
+def init_db():
+    """Create the database tables if they don't exist yet"""
+    db = sqlite3.connect(DATABASE_PATH)
+    # WAL lets readers in other workers run while a registration commits
+    db.execute('PRAGMA journal_mode=WAL')
+    with db:
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS faces (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                x INTEGER NOT NULL,
+                y INTEGER NOT NULL,
+                w INTEGER NOT NULL,
+                h INTEGER NOT NULL,
+                embedding BLOB
+            );
+            CREATE TABLE IF NOT EXISTS attendance (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                timestamp TEXT NOT NULL
+            );
+        """)
+    db.close()
+
+init_db()
+
+# Per-process copy of every stored embedding as one contiguous (N, 128)
+# matrix, reloaded whenever the faces table has changed
+_embedding_cache = {
+    'version': None,
+    'names': [],
+    'embeddings': np.empty((0, FACE_EMBEDDING_SIZE), dtype=np.float32)
+}
+EMBEDDING_CACHE_LOCK = threading.Lock()
+
+def registered_embeddings():
+    """Return (names, embeddings) for all registered faces that have an embedding"""
+    db = get_db()
+    version = db.execute('SELECT COUNT(*), MAX(id) FROM faces WHERE embedding IS NOT NULL').fetchone()
+
+    with EMBEDDING_CACHE_LOCK:
+        if _embedding_cache['version'] != version:
+            rows = db.execute(
+                'SELECT name, embedding FROM faces WHERE embedding IS NOT NULL ORDER BY id'
+            ).fetchall()
+            _embedding_cache['names'] = [name for name, _ in rows]
+            _embedding_cache['embeddings'] = np.frombuffer(
+                b''.join(embedding for _, embedding in rows), dtype=np.float32
+            ).reshape(-1, FACE_EMBEDDING_SIZE)
+            _embedding_cache['version'] = version
+        return _embedding_cache['names'], _embedding_cache['embeddings']
+
 @app.route('/', methods=['GET'])
 def health_check():
     return jsonify({"status": "healthy", "message": "Face Recognition API is running"})
@@ -36,34 +327,37 @@ def process_image():
         # Get processing type from form data
         process_type = request.form.get('type', 'grayscale')
         
-        # Open and process the image
-        image = Image.open(file.stream)
+        # Decode with OpenCV; grayscale output is decoded straight to luminance,
+        # filters keep the upload's channels (gray, BGR or BGRA) as PIL did
+        kernel = FILTER_KERNELS.get(process_type)
+        if kernel is not None:
+            image = decode_image(file, cv2.IMREAD_UNCHANGED)
+        else:
+            image = decode_image(file, cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION)
+        
+        if image is None:
+            return jsonify({"error": "Invalid image format"}), 400
         
         # Apply processing based on type
-        if process_type == 'grayscale':
-            processed_image = image.convert('L')
-        elif process_type == 'blur':
-            processed_image = image.filter(ImageFilter.BLUR)
-        elif process_type == 'sharpen':
-            processed_image = image.filter(ImageFilter.SHARPEN)
-        elif process_type == 'edge':
-            processed_image = image.filter(ImageFilter.FIND_EDGES)
+        if kernel is not None:
+            processed_image = cv2.filter2D(image, -1, kernel)
         else:
-            processed_image = image.convert('L')  # Default to grayscale
+            processed_image = image  # Grayscale, also the default
         
-        # Convert processed image to base64
-        img_buffer = io.BytesIO()
-        processed_image.save(img_buffer, format='PNG')
-        img_buffer.seek(0)
+        # Convert processed image to PNG; zlib level 1 is several times faster
+        # than the default for slightly larger output that is base64'd anyway
+        ok, png = cv2.imencode('.png', processed_image, PNG_ENCODE_PARAMS)
+        if not ok:
+            return jsonify({"error": "Failed to encode processed image"}), 500
         
-        # Encode to base64
-        img_base64 = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
+        # Stream the JSON body, base64-encoding the PNG a chunk at a time
+        # rather than holding the whole encoded image in memory
+        def generate():
+            yield b'{"success": true, "processed_image": "data:image/png;base64,'
+            yield from b64encode_chunks(png)
+            yield b'", "process_type": ' + json.dumps(process_type).encode('utf-8') + b'}'
         
-        return jsonify({
-            "success": True,
-            "processed_image": f"data:image/png;base64,{img_base64}",
-            "process_type": process_type
-        })
+        return Response(generate(), mimetype='application/json')
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -79,30 +373,29 @@ def detect_faces():
         if file.filename == '':
             return jsonify({"error": "No image file selected"}), 400
 
-        # Read image data
-        image_data = file.read()
-
-        # Convert to numpy array
-        nparr = np.frombuffer(image_data, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        # Read and decode image data
+        image = decode_image(file, FACE_IMREAD_FLAGS)
 
         if image is None:
             return jsonify({"error": "Invalid image format"}), 400
 
-        # Load OpenCV face detection model
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-
-        # Convert to grayscale for face detection
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
         # Detect faces
-        faces = face_cascade.detectMultiScale(gray, 1.1, 4)
+        faces = find_faces(image)
+
+        # Compare all faces against registered faces in one batch when a
+        # recognizer is configured
+        matches = [(None, 0.0)] * len(faces)
+        if FACE_RECOGNIZER is not None and faces:
+            queries = np.stack([face_embedding(image, face) for face in faces])
+            matches = match_faces(queries)
 
         # Prepare response data
         faces_data = []
-        for i, (x, y, w, h) in enumerate(faces):
-            # For simplicity, all faces are "Unknown" since we don't have face recognition
-            # In a real implementation, you would extract features and compare with database
+        for i, (face, (match, similarity)) in enumerate(zip(faces, matches)):
+            x, y, w, h, confidence, _ = face
+            name, is_known = "Unknown", False
+            if match is not None and similarity >= FACE_MATCH_THRESHOLD:
+                name, is_known = match, True
 
             faces_data.append({
                 'id': i + 1,
@@ -112,9 +405,9 @@ def detect_faces():
                     'bottom': int(y + h),
                     'left': int(x)
                 },
-                'name': "Unknown",
-                'confidence': 0.8,  # Dummy confidence for detection
-                'is_known': False
+                'name': name,
+                'confidence': confidence,
+                'is_known': is_known
             })
 
         return jsonify({
@@ -146,24 +439,14 @@ def register_face():
         if not name:
             return jsonify({"error": "Name is required"}), 400
 
-        # Read image data
-        image_data = file.read()
-
-        # Convert to numpy array
-        nparr = np.frombuffer(image_data, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        # Read and decode image data
+        image = decode_image(file, FACE_IMREAD_FLAGS)
 
         if image is None:
             return jsonify({"error": "Invalid image format"}), 400
 
-        # Load OpenCV face detection model
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-
-        # Convert to grayscale for face detection
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
         # Detect faces
-        faces = face_cascade.detectMultiScale(gray, 1.1, 4)
+        faces = find_faces(image)
 
         if len(faces) == 0:
             return jsonify({"error": "No face found in the image"}), 400
@@ -171,22 +454,26 @@ def register_face():
         if len(faces) > 1:
             return jsonify({"error": "Multiple faces found. Please use an image with only one face"}), 400
 
-        # For simplicity, just store the name (in real app, you'd store face features)
-        # Extract face region for future comparison (simplified approach)
-        x, y, w, h = faces[0]
-        face_region = image[y:y+h, x:x+w]
+        x, y, w, h, _, _ = faces[0]
 
-        # Store face data (simplified - in production use proper face encoding)
-        face_database['faces'].append({
-            'region': face_region.tolist(),  # Convert to list for JSON serialization
-            'location': {'x': int(x), 'y': int(y), 'w': int(w), 'h': int(h)}
-        })
-        face_database['names'].append(name)
+        # Store the face embedding for comparison in /detect-faces; without a
+        # recognizer only the name and face location are kept
+        embedding = None
+        if FACE_RECOGNIZER is not None:
+            embedding = face_embedding(image, faces[0]).tobytes()
+
+        db = get_db()
+        with db:
+            db.execute(
+                'INSERT INTO faces (name, x, y, w, h, embedding) VALUES (?, ?, ?, ?, ?, ?)',
+                (name, x, y, w, h, embedding)
+            )
+        total_registered = db.execute('SELECT COUNT(*) FROM faces').fetchone()[0]
 
         return jsonify({
             "success": True,
             "message": f"Face registered successfully for {name}",
-            "total_registered": len(face_database['faces'])
+            "total_registered": total_registered
         })
 
     except Exception as e:
@@ -194,18 +481,21 @@ def register_face():
 
 @app.route('/attendance', methods=['GET'])
 def get_attendance():
+    rows = get_db().execute('SELECT name, timestamp FROM attendance ORDER BY id').fetchall()
+    attendance = [{'name': name, 'timestamp': timestamp} for name, timestamp in rows]
     return jsonify({
         "success": True,
-        "attendance": face_database['attendance'],
-        "total_records": len(face_database['attendance'])
+        "attendance": attendance,
+        "total_records": len(attendance)
     })
 
 @app.route('/registered-faces', methods=['GET'])
 def get_registered_faces():
+    names = [name for (name,) in get_db().execute('SELECT name FROM faces ORDER BY id')]
     return jsonify({
         "success": True,
-        "registered_faces": face_database['names'],
-        "total_registered": len(face_database['faces'])
+        "registered_faces": names,
+        "total_registered": len(names)
     })
 
 if __name__ == '__main__':
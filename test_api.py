@@ -8,25 +8,40 @@ import requests
 import base64
 import json
 from PIL import Image
+import numpy as np
 import io
 import os
 
+# Numba compiles the gradient loop to parallel native code; fall back to NumPy if unavailable
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 # API Configuration
 API_BASE_URL = "http://localhost:5000"
 
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _fill_gradient(arr):
+        """Fill an (h, w, 3) uint8 array with the test gradient in place"""
+        h, w, _ = arr.shape
+        for y in prange(h):
+            for x in range(w):
+                arr[y, x, 0] = 255 * x // 100
+                arr[y, x, 1] = 255 * y // 100
+                arr[y, x, 2] = 255 * (x + y) // 200
+
 def create_test_image():
     """Create a simple test image for testing"""
-    # Create a simple 100x100 RGB image with gradient
-    img = Image.new('RGB', (100, 100), color='white')
-    pixels = img.load()
-    
-    for i in range(100):
-        for j in range(100):
-            # Create a simple gradient pattern
-            r = int(255 * i / 100)
-            g = int(255 * j / 100)
-            b = int(255 * (i + j) / 200)
-            pixels[i, j] = (r, g, b)
+    # Create a simple 100x100 RGB image with gradient (red along x, green along y)
+    if njit is not None:
+        arr = np.empty((100, 100, 3), dtype=np.uint8)
+        _fill_gradient(arr)
+    else:
+        y, x = np.mgrid[0:100, 0:100]
+        arr = np.stack([255 * x // 100, 255 * y // 100, 255 * (x + y) // 200], axis=-1).astype(np.uint8)
+    img = Image.fromarray(arr, 'RGB')
     
     # Save to bytes
     img_buffer = io.BytesIO()